@@ -0,0 +1,158 @@
+"""
+Google Sheets logging worker, run in its own process
+
+The web process only pushes rows onto a multiprocessing queue; this process
+owns the gspread client (OAuth refresh, retries, HTTP) and writes the rows in
+batches, so none of that work runs on the request-serving event loop.
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+BACKUP_LOG_PATH = "sheet_log_backup.txt"
+# How often a blocked get() wakes up to check for SIGTERM or a dead parent
+POLL_INTERVAL = 1.0
+# Upper bound on batches flushed after SIGTERM or parent death (20 x 500 covers the web process's queue)
+MAX_DRAIN_BATCHES = 20
+
+_terminating = False
+
+
+def _request_stop(signum, frame) -> None:
+    global _terminating
+    _terminating = True
+
+
+def should_stop() -> bool:
+    """True once SIGTERM arrived or the web process is gone without sending the sentinel."""
+    parent = multiprocessing.parent_process()
+    return _terminating or (parent is not None and not parent.is_alive())
+
+
+def connect_sheet(creds_path: str, sheet_url: str):
+    """Opens the "conversations" worksheet, or returns None if setup fails."""
+    try:
+        # Imported here so the web process, which imports this module only to
+        # reference run(), never loads gspread/google-auth
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        if not creds_path or not os.path.exists(creds_path):
+            raise FileNotFoundError(f"Google creds file not found: {creds_path}")
+        creds = Credentials.from_service_account_file(
+            creds_path,
+            scopes=["https://www.googleapis.com/auth/spreadsheets"]
+        )
+        gc = gspread.authorize(creds)
+        if not sheet_url:
+            raise RuntimeError("SHEET_URL not set in environment")
+        sheet = gc.open_by_url(sheet_url).worksheet("conversations")
+        print("✅ Successfully connected to Google Sheets")
+        return sheet
+    except Exception as e:
+        print(f"⚠️  Warning: Google Sheets setup failed: {str(e)}")
+        return None
+
+
+def append_rows(sheet, rows: list, backup_file) -> None:
+    """
+    Writes a batch of rows in a single Sheets v4 values.append request
+    INSERT_ROWS + a fixed A:F table range keeps appends from overwriting or drifting columns
+    """
+    if sheet is None:
+        print(f"⚠️  Skipping Google Sheets log for {len(rows)} rows; sheet is not initialized.")
+        return
+    try:
+        sheet.append_rows(
+            rows,
+            value_input_option="RAW",
+            insert_data_option="INSERT_ROWS",
+            table_range="A:F",
+        )
+        print(f"✅ Logged {len(rows)} rows to Sheets")
+    except Exception as e:
+        print(f"❌ Google Sheets append failed: {e}")
+        # Backup logging to local file
+        try:
+            if backup_file is None:
+                raise RuntimeError(f"{BACKUP_LOG_PATH} is not open")
+            backup_file.writelines(", ".join(row) + "\n" for row in rows)
+            print(f"📝 Backed up to local file: {BACKUP_LOG_PATH}")
+        except Exception as backup_e:
+            print(f"❌ Backup logging also failed: {backup_e}")
+
+
+def collect_batch(log_q, flush_interval: float, max_batch: int):
+    """
+    Waits for the first row, then gathers more until flush_interval has passed
+    or max_batch rows are collected. Returns (rows, stop) where stop means the
+    None sentinel was received or should_stop() turned true.
+    """
+    rows = []
+    deadline = None
+    while len(rows) < max_batch:
+        if should_stop():
+            return rows, True
+        timeout = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.monotonic())
+        if timeout <= 0:
+            break
+        try:
+            row = log_q.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if row is None:
+            return rows, True
+        rows.append(row)
+        if deadline is None:
+            deadline = time.monotonic() + flush_interval
+    return rows, False
+
+
+def drain(log_q, max_batch: int) -> list:
+    """Takes whatever is already queued without waiting, up to max_batch rows."""
+    rows = []
+    while len(rows) < max_batch:
+        try:
+            row = log_q.get_nowait()
+        except (queue.Empty, OSError, EOFError):
+            break
+        if row is None:
+            break
+        rows.append(row)
+    return rows
+
+
+def run(log_q, creds_path: str, sheet_url: str, flush_interval: float = 2.0, max_batch: int = 500) -> None:
+    """Process entry point: drains log_q into Sheets until a None sentinel, SIGTERM or parent exit."""
+    # Normal shutdown is driven by the parent's sentinel, so Ctrl+C reaching the
+    # whole process group must not cut it short. SIGTERM and a dead parent end
+    # the loop instead, after flushing what is already queued.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _request_stop)
+
+    sheet = connect_sheet(creds_path, sheet_url)
+    # Fallback for rows Sheets rejects; opened once for the worker's lifetime
+    try:
+        backup_file = open(BACKUP_LOG_PATH, "a", buffering=1, encoding="utf-8")
+    except OSError as e:
+        print(f"⚠️  Warning: could not open {BACKUP_LOG_PATH}: {e}")
+        backup_file = None
+
+    try:
+        stop = False
+        while not stop:
+            rows, stop = collect_batch(log_q, flush_interval, max_batch)
+            if rows:
+                append_rows(sheet, rows, backup_file)
+        if should_stop():
+            # No sentinel is coming; flush the backlog, bounded in case rows keep arriving
+            for _ in range(MAX_DRAIN_BATCHES):
+                rows = drain(log_q, max_batch)
+                if not rows:
+                    break
+                append_rows(sheet, rows, backup_file)
+    finally:
+        if backup_file is not None:
+            backup_file.close()